@@ -1,36 +1,138 @@
 import firebase_admin
-from firebase_admin import auth, credentials, firestore
-import json
+from firebase_admin import auth, credentials, exceptions, firestore
+from google.cloud.firestore_v1.bulk_writer import BulkRetry, BulkWriteFailure, BulkWriter, BulkWriterOptions
+from google.cloud.firestore_v1.field_path import FieldPath
+import ijson
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+import argparse
+import atexit
+import hashlib
 import logging
+import os
+import queue
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
-from typing import Dict, Any, Optional
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Any, Iterable, Iterator, List, Set, Tuple
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='migration.log'
+# Set up logging; records are queued and written to disk by a listener thread
+# so worker threads do not block on file I/O
+LOG_QUEUE = queue.Queue(-1)
+log_file_handler = RotatingFileHandler('migration.log', maxBytes=50_000_000, backupCount=5)
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+LOG_LISTENER = QueueListener(LOG_QUEUE, log_file_handler)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(LOG_QUEUE))
+
+# Firebase Auth accepts at most 1000 users per import_users call
+IMPORT_BATCH_SIZE = 1000
+
+# Firebase Auth accepts at most 100 identifiers per get_users call
+GET_USERS_BATCH_SIZE = 100
+
+# Seed password for migrated users. Cognito does not export password hashes, so the
+# default password is hashed here once and imported as-is; every user gets the same
+# hash, since it is the same password anyway
+DEFAULT_PASSWORD = "Default@123"
+DEFAULT_PASSWORD_SALT = os.urandom(16)
+SCRYPT_MEMORY_COST = 1024
+SCRYPT_BLOCK_SIZE = 8
+SCRYPT_PARALLELIZATION = 16
+SCRYPT_KEY_LENGTH = 64
+DEFAULT_PASSWORD_HASH = hashlib.scrypt(
+    DEFAULT_PASSWORD.encode(),
+    salt=DEFAULT_PASSWORD_SALT,
+    n=SCRYPT_MEMORY_COST,
+    r=SCRYPT_BLOCK_SIZE,
+    p=SCRYPT_PARALLELIZATION,
+    dklen=SCRYPT_KEY_LENGTH
+)
+PASSWORD_HASH_ALG = auth.UserImportHash.standard_scrypt(
+    memory_cost=SCRYPT_MEMORY_COST,
+    parallelization=SCRYPT_PARALLELIZATION,
+    block_size=SCRYPT_BLOCK_SIZE,
+    derived_key_length=SCRYPT_KEY_LENGTH
+)
+
+# Cognito attribute values treated as boolean true
+TRUE_VALUES = frozenset(("true", "True", "TRUE", "1", "yes"))
+
+# Firebase Auth only accepts E.164 formatted phone numbers
+E164_PATTERN = re.compile(r'^\+[1-9]\d{1,14}$')
+
+# Number of attempts BulkWriter makes for a Firestore write before giving up
+MAX_WRITE_ATTEMPTS = 5
+
+# Back off exponentially between Firestore write attempts instead of linearly. Retries
+# wait attempts**2 seconds, so writes failing near the end of a run are often still
+# pending when it finishes: always flush() a bulk writer before close()
+BULK_WRITER_OPTIONS = BulkWriterOptions(retry=BulkRetry.exponential)
+
+# Firebase errors caused by quota throttling or transient outages, worth retrying
+RETRYABLE_ERRORS = (
+    exceptions.ResourceExhaustedError,
+    exceptions.UnavailableError,
+    exceptions.DeadlineExceededError
 )
 
-def get_attribute_value(attributes: list, name: str) -> Optional[str]:
-    """Helper function to get attribute value from Cognito user attributes."""
-    return next((attr["Value"] for attr in attributes if attr["Name"] == name), None)
+# Retry policy for Firebase Auth calls; the last error is re-raised once attempts run out
+retry_firebase_call = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True
+)
+
+# Default number of import batches migrated concurrently
+DEFAULT_MAX_WORKERS = 40
+
+# BulkWriter is not thread-safe, so writes from worker threads are serialized
+BULK_WRITER_LOCK = threading.Lock()
 
-def create_firestore_user_data(user_data: Dict[str, Any], user_record: auth.UserRecord) -> Dict[str, Any]:
+# Default Firebase app, initialized on first use by ensure_app()
+FIREBASE_APP = None
+
+# Usernames of fully migrated users, one per line, so interrupted runs can resume
+CHECKPOINT_FILE = "checkpoint.txt"
+CHECKPOINT_LOCK = threading.Lock()
+
+def ensure_app() -> firebase_admin.App:
+    """Initialize the Firebase Admin SDK once and return the default app."""
+    global FIREBASE_APP
+    if FIREBASE_APP:
+        return FIREBASE_APP
+    try:
+        FIREBASE_APP = firebase_admin.get_app()
+    except ValueError:
+        cred = credentials.Certificate("service-account.json")
+        FIREBASE_APP = firebase_admin.initialize_app(cred)
+    return FIREBASE_APP
+
+def attrs_to_dict(attributes: List[Dict[str, str]]) -> Dict[str, str]:
+    """Helper function to map Cognito user attributes by name."""
+    return {attr["Name"]: attr["Value"] for attr in attributes}
+
+def create_firestore_user_data(user_data: Dict[str, Any], attrs: Dict[str, str], user_record: auth.ImportUserRecord) -> Dict[str, Any]:
     """Create Firestore user document data preserving all Cognito attributes."""
-    attributes = user_data["Attributes"]
-    
     # Create exact Cognito data structure in Firestore
     return {
         "Username": user_data["Username"],  # Original Cognito Username
         "Attributes": {
-            "email": get_attribute_value(attributes, "email"),
-            "email_verified": get_attribute_value(attributes, "email_verified") == "true",
-            "phone_number": get_attribute_value(attributes, "phone_number"),
-            "phone_number_verified": get_attribute_value(attributes, "phone_number_verified") == "true",
-            "family_name": get_attribute_value(attributes, "family_name"),
-            "given_name": get_attribute_value(attributes, "given_name"),
-            "sub": get_attribute_value(attributes, "sub")
+            "email": attrs.get("email"),
+            "email_verified": attrs.get("email_verified") in TRUE_VALUES,
+            "phone_number": attrs.get("phone_number"),
+            "phone_number_verified": attrs.get("phone_number_verified") in TRUE_VALUES,
+            "family_name": attrs.get("family_name"),
+            "given_name": attrs.get("given_name"),
+            "sub": attrs.get("sub")
         },
         "UserCreateDate": user_data["UserCreateDate"],
         "UserLastModifiedDate": user_data["UserLastModifiedDate"],
@@ -40,108 +142,281 @@ def create_firestore_user_data(user_data: Dict[str, Any], user_record: auth.User
         "firebase_uid": user_record.uid
     }
 
-def migrate_user(user_data: Dict[str, Any], db: firestore.Client) -> Optional[auth.UserRecord]:
-    """Migrate a user to both Firebase Auth and Firestore."""
-    attributes = user_data["Attributes"]
+@retry_firebase_call
+def import_users_with_retry(records: List[auth.ImportUserRecord]) -> auth.UserImportResult:
+    """Import users into Firebase Auth, retrying when throttled."""
+    return auth.import_users(records, hash_alg=PASSWORD_HASH_ALG)
+
+@retry_firebase_call
+def delete_users_with_retry(uids: List[str]) -> auth.DeleteUsersResult:
+    """Delete users from Firebase Auth, retrying when throttled."""
+    return auth.delete_users(uids)
+
+@retry_firebase_call
+def generate_password_reset_link_with_retry(email: str) -> str:
+    """Generate a password reset link, retrying when throttled."""
+    return auth.generate_password_reset_link(email)
+
+@retry_firebase_call
+def get_users_with_retry(identifiers: List[auth.UserIdentifier]) -> auth.GetUsersResult:
+    """Look up Firebase Auth users, retrying when throttled."""
+    return auth.get_users(identifiers)
+
+def find_existing_users(records: List[auth.ImportUserRecord]) -> Tuple[Set[str], Dict[str, str]]:
+    """Look up Firebase Auth accounts matching the records by uid or by email.
     
+    Returns the set of matching uids and a mapping of lowercased email to the uid owning it.
+    """
+    # Each record is looked up by both uid and email, so half as many records fit per call
+    records_per_call = GET_USERS_BATCH_SIZE // 2
+    existing_uids = set()
+    email_owners = {}
+    for start in range(0, len(records), records_per_call):
+        identifiers = []
+        for record in records[start:start + records_per_call]:
+            identifiers.append(auth.UidIdentifier(record.uid))
+            identifiers.append(auth.EmailIdentifier(record.email))
+        for user in get_users_with_retry(identifiers).users:
+            existing_uids.add(user.uid)
+            if user.email:
+                email_owners[user.email.lower()] = user.uid
+    return existing_uids, email_owners
+
+def build_import_record(user_data: Dict[str, Any], attrs: Dict[str, str]) -> auth.ImportUserRecord:
+    """Build a Firebase Auth import record from a Cognito user with an email."""
     # Get required fields
-    email = get_attribute_value(attributes, "email")
-    email_verified = get_attribute_value(attributes, "email_verified")
-    phone_number = get_attribute_value(attributes, "phone_number")
-    given_name = get_attribute_value(attributes, "given_name")
-    family_name = get_attribute_value(attributes, "family_name")
+    email = attrs.get("email")
+    email_verified = attrs.get("email_verified") in TRUE_VALUES
+    phone_number = attrs.get("phone_number")
+    given_name = attrs.get("given_name")
+    family_name = attrs.get("family_name")
     
-    if not email:
-        logging.warning(f"Skipping user: No email found")
-        return None
-
-    try:
-        # 1. Create Firebase Auth user with all supported fields
-        user_kwargs = {
-            "uid": user_data["Username"],  # Use Cognito Username as Firebase UID
-            "email": email,
-            "password": "Default@123",
-            "email_verified": email_verified.lower() == "true" if email_verified else False,
-            "display_name": f"{given_name} {family_name}".strip() if given_name or family_name else None,
-            "disabled": not user_data["Enabled"]
-        }
-        
-        # Only add phone number if it exists
-        if phone_number:
+    user_kwargs = {
+        "uid": user_data["Username"],  # Use Cognito Username as Firebase UID
+        "email": email,
+        "email_verified": email_verified,
+        "disabled": not user_data["Enabled"],
+        "password_hash": DEFAULT_PASSWORD_HASH,
+        "password_salt": DEFAULT_PASSWORD_SALT
+    }
+    
+    # Only add display name if the user has a given or family name
+    display_name = " ".join(name for name in (given_name, family_name) if name)
+    if display_name:
+        user_kwargs["display_name"] = display_name
+    
+    # Only add phone number if it is valid E.164, otherwise the whole record is rejected
+    if phone_number:
+        if E164_PATTERN.match(phone_number):
             user_kwargs["phone_number"] = phone_number
-        
-        # Remove None values
-        user_kwargs = {k: v for k, v in user_kwargs.items() if v is not None}
-        
+        else:
+            logging.warning(f"Invalid phone number for {email}: {phone_number}. Importing user without phone.")
+    
+    return auth.ImportUserRecord(**user_kwargs)
+
+def should_retry_write(failure: BulkWriteFailure, action: str) -> bool:
+    """Decide whether a failed Firestore write is retried, logging the ones that are given up on.
+    
+    action describes the operation in the log message, e.g. "write" or "delete".
+    """
+    if failure.attempts < MAX_WRITE_ATTEMPTS:
+        return True
+    logging.error(f"Failed to {action} Firestore data for user {failure.operation.reference.id}: {failure.message}")
+    return False
+
+def migrate_batch(
+    users: List[Dict[str, Any]],
+    users_ref: firestore.CollectionReference,
+    bulk_writer: BulkWriter,
+    reset_emails: Dict[str, str]
+) -> int:
+    """Migrate a batch of users to both Firebase Auth and Firestore.
+    
+    Firestore writes are queued on the bulk writer, which commits them in the background
+    and reports their outcome through its callbacks. The emails of newly imported users are
+    added to reset_emails by uid until their Firestore write completes.
+    Returns the number of users that failed before their Firestore write was queued.
+    """
+    records = []
+    firestore_docs = []
+    failed = 0
+    
+    for user_data in users:
         try:
-            # Check if user exists in Auth
-            user_record = auth.get_user_by_email(email)
-            logging.info(f"User {email} already exists in Auth")
-        except auth.UserNotFoundError:
-            try:
-                # First try to create user with phone number (if provided)
-                user_record = auth.create_user(**user_kwargs)
-                logging.info(f"Created Auth user with phone: {email}")
-            except Exception as e:
-                if "INVALID_PHONE_NUMBER" in str(e) or "PHONE_NUMBER_EXISTS" in str(e):
-                    # If phone number is invalid or exists, try again without phone
-                    logging.warning(f"Phone number issue for {email}: {str(e)}. Creating user without phone.")
-                    user_kwargs.pop('phone_number', None)
-                    user_record = auth.create_user(**user_kwargs)
-                    logging.info(f"Created Auth user without phone: {email}")
-                else:
-                    # If it's a different error, raise it
-                    raise
+            # Index attributes once and reuse them for both Auth and Firestore data
+            attrs = attrs_to_dict(user_data["Attributes"])
+            record = build_import_record(user_data, attrs)
             
-            # Generate password reset link
-            reset_link = auth.generate_password_reset_link(email)
-            logging.info(f"Password reset link for {email}: {reset_link}")
-        
-        # 2. Store complete Cognito data structure in Firestore (including phone number)
-        users_ref = db.collection('users')
-        user_doc_ref = users_ref.document(user_record.uid)
-        
-        # Create or update Firestore document with exact Cognito structure
-        firestore_data = create_firestore_user_data(user_data, user_record)
-        user_doc_ref.set(firestore_data, merge=True)
-        logging.info(f"Updated Firestore data for user: {email}")
+            # Build the Firestore document up front too, so incomplete users never reach Auth
+            firestore_data = create_firestore_user_data(user_data, attrs, record)
+        except Exception as e:
+            # ImportUserRecord rejects malformed emails and uids, and the Firestore document
+            # needs every Cognito field; skip just this user
+            logging.error(f"Error migrating user {user_data.get('Username')}: {str(e)}")
+            failed += 1
+            continue
+        records.append(record)
+        firestore_docs.append(firestore_data)
+    
+    if not records:
+        return failed
+    
+    try:
+        # 1. Import new users into Firebase Auth. import_users overwrites existing accounts,
+        # including their password, and does not enforce unique emails, so users whose uid
+        # or email already belongs to an account are not imported
+        existing_uids, email_owners = find_existing_users(records)
+        failed_uids = set()
+        new_records = []
+        for record in records:
+            if record.uid in existing_uids:
+                continue
+            owner_uid = email_owners.get(record.email.lower())
+            if owner_uid:
+                logging.error(f"Error migrating user {record.email}: Email already used by Firebase user {owner_uid}")
+                failed_uids.add(record.uid)
+                continue
+            new_records.append(record)
+        errors = import_users_with_retry(new_records).errors if new_records else []
+    except Exception as e:
+        logging.error(f"Error importing batch of {len(records)} users: {str(e)}")
+        return failed + len(records)
+    
+    for error in errors:
+        record = new_records[error.index]
+        failed_uids.add(record.uid)
+        logging.error(f"Error migrating user {record.email}: {error.reason}")
+    
+    # 2. Store complete Cognito data structure in Firestore (including phone number)
+    for firestore_data, record in zip(firestore_docs, records):
+        if record.uid in failed_uids:
+            failed += 1
+            continue
         
-        return user_record
+        email = record.email
+        try:
+            is_new_user = record.uid not in existing_uids
+            if is_new_user:
+                logging.info(f"Imported Auth user: {email}")
+            else:
+                logging.info(f"User {email} already exists in Auth")
             
+            # Create or update Firestore document with exact Cognito structure
+            user_doc_ref = users_ref.document(record.uid)
+            with BULK_WRITER_LOCK:
+                # New users get a password reset link once their Firestore write succeeds
+                if is_new_user:
+                    reset_emails[record.uid] = email
+                bulk_writer.set(user_doc_ref, firestore_data, merge=True)
+            logging.info(f"Queued Firestore data for user: {email}")
+        except Exception as e:
+            logging.error(f"Error migrating user {email}: {str(e)}")
+            failed += 1
+    
+    return failed
+
+def log_password_reset_link(email: str) -> None:
+    """Generate and log a password reset link for a migrated user."""
+    try:
+        reset_link = generate_password_reset_link_with_retry(email)
+        logging.info(f"Password reset link for {email}: {reset_link}")
     except Exception as e:
-        logging.error(f"Error migrating user {email}: {str(e)}")
-        return None
+        logging.error(f"Failed to generate password reset link for {email}: {str(e)}")
+
+def load_checkpoint() -> Set[str]:
+    """Load the Usernames of users migrated by previous runs."""
+    try:
+        with open(CHECKPOINT_FILE, "r") as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def clear_checkpoint() -> None:
+    """Forget previous runs so the next migration processes every user again."""
+    try:
+        os.remove(CHECKPOINT_FILE)
+    except FileNotFoundError:
+        pass
+
+def skip_migrated(users: Iterable[Dict[str, Any]], migrated: Set[str], stats: Dict[str, int]) -> Iterator[Dict[str, Any]]:
+    """Yield users not migrated by a previous run, counting the others as skipped."""
+    for user_data in users:
+        # Malformed entries are passed on and counted as failed by migrate_batch
+        if user_data.get("Username") in migrated:
+            stats["skipped"] += 1
+            continue
+        yield user_data
+
+def skip_without_email(users: Iterable[Dict[str, Any]], stats: Dict[str, int]) -> Iterator[Dict[str, Any]]:
+    """Yield users that have an email, counting the others as skipped (Firebase Auth requires one)."""
+    for user_data in users:
+        if any(attr.get("Name") == "email" and attr.get("Value") for attr in user_data.get("Attributes") or []):
+            yield user_data
+            continue
+        logging.warning(f"Skipping user {user_data.get('Username')}: No email found")
+        stats["skipped_no_email"] += 1
+
+def iter_batches(users: Iterable[Dict[str, Any]], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Yield lists of up to batch_size users from an iterable of users."""
+    users = iter(users)
+    while True:
+        batch = list(islice(users, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def update_stats(stats: Dict[str, int], stats_lock: threading.Lock, futures: Iterable[Future]) -> None:
+    """Add the failure counts of finished migrate_batch futures to stats."""
+    for future in futures:
+        failed = future.result()
+        with stats_lock:
+            stats["failed"] += failed
 
 def delete_firestore_users():
     """Delete all users from Firestore."""
     try:
         # Initialize Firebase Admin SDK if not already initialized
-        try:
-            app = firebase_admin.get_app()
-        except ValueError:
-            cred = credentials.Certificate("service-account.json")
-            firebase_admin.initialize_app(cred)
+        ensure_app()
         
         # Initialize Firestore
         db = firestore.client()
         
-        # Get all users from Firestore
-        deleted_count = 0
-        failed_count = 0
+        # Deletions are reported asynchronously by the bulk writer
+        counts = {"deleted": 0, "failed": 0}
+        counts_lock = threading.Lock()
+        
+        def handle_delete_result(reference, write_result, bulk_writer):
+            logging.info(f"Deleted Firestore data for user: {reference.id}")
+            with counts_lock:
+                counts["deleted"] += 1
         
-        # Delete users collection
+        def handle_delete_error(failure, bulk_writer):
+            if should_retry_write(failure, "delete"):
+                return True
+            with counts_lock:
+                counts["failed"] += 1
+            return False
+        
+        # Batch deletes instead of committing one document at a time
+        bulk_writer = db.bulk_writer(BULK_WRITER_OPTIONS)
+        bulk_writer.on_write_result(handle_delete_result)
+        bulk_writer.on_write_error(handle_delete_error)
+        
+        # Delete users collection, streaming only document names since the data is not needed
         users_ref = db.collection('users')
-        docs = users_ref.stream()
+        docs = users_ref.select([FieldPath.document_id()]).stream()
         
-        for doc in docs:
-            try:
-                doc.reference.delete()
-                logging.info(f"Deleted Firestore data for user: {doc.id}")
-                deleted_count += 1
-            except Exception as e:
-                logging.error(f"Failed to delete Firestore data for user {doc.id}: {str(e)}")
-                failed_count += 1
+        try:
+            for doc in docs:
+                bulk_writer.delete(doc.reference)
+        finally:
+            # Wait for all queued deletes to be committed; flush before closing so that
+            # retries re-queued during the flush are still accepted
+            bulk_writer.flush()
+            bulk_writer.close()
         
+        deleted_count = counts["deleted"]
+        failed_count = counts["failed"]
         logging.info(f"Firestore deletion completed! Deleted: {deleted_count}, Failed: {failed_count}")
         return deleted_count, failed_count
         
@@ -153,45 +428,49 @@ def delete_auth_users(delete_firestore=True):
     """Delete users from Firebase Authentication and optionally from Firestore."""
     try:
         # Initialize Firebase Admin SDK if not already initialized
-        try:
-            app = firebase_admin.get_app()
-        except ValueError:
-            cred = credentials.Certificate("service-account.json")
-            firebase_admin.initialize_app(cred)
-        
-        # Delete Firestore data first if requested
-        if delete_firestore:
-            firestore_deleted, firestore_failed = delete_firestore_users()
-            logging.info(f"Firestore deletion: Deleted {firestore_deleted}, Failed {firestore_failed}")
-        
-        # Get all users from Firebase Auth
-        auth_deleted = 0
-        auth_failed = 0
+        ensure_app()
         
-        # Delete users in batches (Firebase has a limit of 1000 users per batch)
-        page = auth.list_users()
-        while page:
-            for user in page.users:
+        # Delete Firestore data in the background while Auth users are deleted, if requested
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            firestore_future = executor.submit(delete_firestore_users) if delete_firestore else None
+            
+            # Get all users from Firebase Auth
+            auth_deleted = 0
+            auth_failed = 0
+            
+            # Delete users in batches (Firebase has a limit of 1000 users per batch)
+            page = auth.list_users()
+            while page:
+                users = page.users
                 try:
-                    # Delete from Authentication
-                    auth.delete_user(user.uid)
-                    logging.info(f"Deleted auth user {user.email} (UID: {user.uid})")
-                    auth_deleted += 1
+                    # Delete the whole page from Authentication in one request
+                    result = delete_users_with_retry([user.uid for user in users])
+                    auth_deleted += result.success_count
+                    auth_failed += result.failure_count
+                    for error in result.errors:
+                        user = users[error.index]
+                        logging.error(f"Failed to delete auth user {user.email}: {error.reason}")
+                    logging.info(f"Deleted {result.success_count} auth users")
                 except Exception as e:
-                    logging.error(f"Failed to delete auth user {user.email}: {str(e)}")
-                    auth_failed += 1
+                    logging.error(f"Failed to delete batch of {len(users)} auth users: {str(e)}")
+                    auth_failed += len(users)
+                
+                # Get next batch of users
+                page = page.get_next_page()
             
-            # Get next batch of users
-            page = page.get_next_page()
+            logging.info(f"Auth deletion completed! Deleted: {auth_deleted}, Failed: {auth_failed}")
+            
+            if firestore_future:
+                firestore_deleted, firestore_failed = firestore_future.result()
+                logging.info(f"Firestore deletion: Deleted {firestore_deleted}, Failed {firestore_failed}")
         
-        logging.info(f"Auth deletion completed! Deleted: {auth_deleted}, Failed: {auth_failed}")
         return auth_deleted, auth_failed
         
     except Exception as e:
         logging.error(f"Fatal error during deletion: {str(e)}")
         raise
 
-def main():
+def main(max_workers: int = DEFAULT_MAX_WORKERS):
     """Main function with added deletion option."""
     try:
         while True:
@@ -199,45 +478,113 @@ def main():
             
             if action == "1":
                 # Initialize Firebase Admin SDK
-                try:
-                    app = firebase_admin.get_app()
-                except ValueError:
-                    cred = credentials.Certificate("service-account.json")
-                    firebase_admin.initialize_app(cred)
+                ensure_app()
                 
                 # Initialize Firestore
                 db = firestore.client()
                 
-                # Load Cognito users
-                with open("cognito_users.json", "r") as f:
-                    cognito_data = json.load(f)
-                
-                # Track migration statistics
+                # Track migration statistics (total is counted while streaming)
                 stats = {
-                    "total": len(cognito_data["Users"]),
+                    "total": 0,
                     "success": 0,
-                    "failed": 0
+                    "failed": 0,
+                    "skipped": 0,
+                    "skipped_no_email": 0
                 }
                 
-                # Process users
-                for user in cognito_data["Users"]:
-                    result = migrate_user(user, db)
-                    if result:
-                        stats["success"] += 1
-                    else:
+                # Successes and Firestore failures are counted from the bulk writer's callbacks
+                stats_lock = threading.Lock()
+                
+                # Users migrated by previous runs are skipped
+                migrated = load_checkpoint()
+                
+                # Resolve the users collection once for all batches
+                users_ref = db.collection('users')
+                
+                # Emails of new users whose Firestore write is in flight, keyed by uid
+                reset_emails = {}
+                
+                # Password reset links are generated in the background as writes complete;
+                # the semaphore bounds how many links can be waiting at once
+                reset_executor = ThreadPoolExecutor(max_workers=max_workers)
+                reset_slots = threading.BoundedSemaphore(max_workers * IMPORT_BATCH_SIZE)
+                
+                # Batch Firestore writes instead of committing one document at a time
+                bulk_writer = db.bulk_writer(BULK_WRITER_OPTIONS)
+                
+                def handle_migrate_error(failure, bulk_writer):
+                    if should_retry_write(failure, "write"):
+                        return True
+                    reset_emails.pop(failure.operation.reference.id, None)
+                    with stats_lock:
                         stats["failed"] += 1
+                    return False
+                
+                bulk_writer.on_write_error(handle_migrate_error)
+                
+                # Stream Cognito users instead of loading the whole export into memory
+                with open("cognito_users.json", "rb") as f, open(CHECKPOINT_FILE, "a") as checkpoint:
+                    users = skip_migrated(ijson.items(f, "Users.item", use_float=True), migrated, stats)
+                    users = skip_without_email(users, stats)
+                    
+                    # A user is migrated, and checkpointed, once their Firestore document is committed
+                    def handle_write_result(reference, write_result, bulk_writer):
+                        logging.info(f"Updated Firestore data for user: {reference.id}")
+                        with CHECKPOINT_LOCK:
+                            checkpoint.write(reference.id + "\n")
+                            checkpoint.flush()
+                        with stats_lock:
+                            stats["success"] += 1
+                        
+                        email = reset_emails.pop(reference.id, None)
+                        if email:
+                            reset_slots.acquire()
+                            reset_future = reset_executor.submit(log_password_reset_link, email)
+                            reset_future.add_done_callback(lambda future: reset_slots.release())
+                    
+                    bulk_writer.on_write_result(handle_write_result)
+                    
+                    # Process import batches concurrently
+                    try:
+                        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                            pending = set()
+                            for batch in iter_batches(users, IMPORT_BATCH_SIZE):
+                                stats["total"] += len(batch)
+                                pending.add(executor.submit(migrate_batch, batch, users_ref, bulk_writer, reset_emails))
+                                
+                                # Bound the number of batches held in memory
+                                if len(pending) >= max_workers * 2:
+                                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                                    update_stats(stats, stats_lock, done)
+                            
+                            update_stats(stats, stats_lock, as_completed(pending))
+                    finally:
+                        # Wait for all queued Firestore writes to be committed, then for their reset links.
+                        # flush() must come first: close() rejects new operations, including retries
+                        # of failed writes that the writer re-queues while flushing
+                        try:
+                            bulk_writer.flush()
+                            bulk_writer.close()
+                        finally:
+                            reset_executor.shutdown(wait=True)
                 
                 # Log final statistics
                 logging.info("Migration completed!")
                 logging.info(f"Total users processed: {stats['total']}")
                 logging.info(f"Successfully migrated: {stats['success']}")
                 logging.info(f"Failed to migrate: {stats['failed']}")
+                logging.info(f"Skipped (migrated by a previous run): {stats['skipped']}")
+                logging.info(f"Skipped (no email): {stats['skipped_no_email']}")
             
             elif action == "2":
                 delete_type = input("Delete from (1: Both Auth and Firestore, 2: Auth only, 3: Firestore only): ")
                 confirm = input("Are you sure? This will permanently delete the data (yes/no): ")
                 
                 if confirm.lower() == "yes":
+                    if delete_type in ("1", "2", "3"):
+                        # Deleted users have to be migrated again on the next run
+                        clear_checkpoint()
+                    
                     if delete_type == "1":
                         auth_deleted, auth_failed = delete_auth_users(delete_firestore=True)
                         print(f"Deleted from Auth: {auth_deleted}, Failed: {auth_failed}")
@@ -264,4 +611,12 @@ def main():
         raise
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migrate AWS Cognito users to Firebase Auth and Firestore.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"Number of import batches to migrate concurrently (default: {DEFAULT_MAX_WORKERS})"
+    )
+    args = parser.parse_args()
+    main(max_workers=args.workers)
\ No newline at end of file